@@ -181,7 +181,8 @@ class RNASystem(BaseDataLoader):
         Parameters
         ----------
         weights : numpy.ndarray, optional
-            Weights to compute the J-couplings. Default is None.
+            Normalized weights of each frame to compute the weighted average and standard deviation
+            of the J-couplings. Default is None.
 
         couplings : str, optional
             Name of the couplings to compute. Default is None. 
@@ -223,6 +224,14 @@ class RNASystem(BaseDataLoader):
         # Convert numpy.float to float to avoid serialization issues
         replace_nan_with_none = lambda x: None if np.isscalar(x) and np.isnan(x) else x.item()
 
+        # Weighted average and standard deviation of all residues and couplings: [M, X]
+        # <x> = sum_i w_i x_i, <x^2> = sum_i w_i x_i^2, std = sqrt(<x^2> - <x>^2)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            avgs = np.einsum('i,ijk->jk', weights, values, optimize=True)
+            sq_avgs = np.einsum('i,ijk->jk', weights, values * values, optimize=True)
+            stds = np.sqrt(np.maximum(sq_avgs - avgs * avgs, 0.0))
+
         # Loop over residues and couplings to store the computed values
         coupling_dict = dict()
         for i, resname in enumerate(resname_list):
@@ -234,12 +243,8 @@ class RNASystem(BaseDataLoader):
                 avg_raw = replace_nan_with_none(avg_raw)
                 std_raw = replace_nan_with_none(std_raw)
                 if weights is not None:
-                    arr = _values[:,j] * weights
-                    #_logger.info(f'non-weighted: {_values[:,j]}')
-                    #_logger.info(f'weights:      {weights}')
-                    #_logger.info(f'weighted:     {arr}')
-                    avg = np.round(arr.mean(), 5)
-                    std = np.round(arr.std(), 5)
+                    avg = np.round(avgs[i,j], 5)
+                    std = np.round(stds[i,j], 5)
                     avg = replace_nan_with_none(avg)
                     std = replace_nan_with_none(std)
                 else:
@@ -699,6 +699,10 @@ class SetupSampler(BaseSimulation):
             self.new_solvated_system = self.modeller_solvated_system
             self.new_solvated_topology = self.modeller_solvated_topology
 
+        # Assign each force to its own force group so that energies can be evaluated per force group
+        for i, force in enumerate(self.new_solvated_system.getForces()):
+            force.setForceGroup(min(i, 31))
+
         # Save solvated pdb file
         outfile = os.path.join(self.output_directory_path, f"solvated.pdb")
         with open(f"{outfile}", "w") as wf:
@@ -405,7 +405,8 @@ class EspalomaModel(EspalomaBase):
                     self._save_checkpoint(epoch)
     
     
-    def train_sampler(self, sampler_patience=800, neff_threshold=0.2, sampler_weight=1.0, debug=False):
+    def train_sampler(self, sampler_patience=800, neff_threshold=0.2, sampler_weight=1.0, nprocs=1, max_workers=1,
+                      debug=False):
         """
         Train the Espaloma network model with sampler.
 
@@ -420,6 +421,16 @@ class EspalomaModel(EspalomaBase):
         sampler_weight : float, default=1.0
             The weight for the sampler loss.
 
+        nprocs : int, default=1
+            The number of processes used to compute the effective sample size. If larger than 1, worker
+            processes are spawned at every epoch using the sampler, and each worker re-imports espfit and
+            rebuilds the OpenMM contexts. The calling script must guard its entry point with
+            `if __name__ == '__main__':` since spawned workers re-import the `__main__` module.
+
+        max_workers : int, default=1
+            The number of threads used to run the samplers and compute the sampler loss concurrently.
+            Only useful if the samplers run on different devices.
+
         debug : bool, default=False
             If True, use espaloma-0.3.pt for debugging.
 
@@ -521,17 +532,18 @@ class EspalomaModel(EspalomaBase):
                     # Save checkpoint as local model (net.pt)
                     # `neff_min` is -1 if SamplerReweight.samplers is None
                     samplers = self._setup_local_samplers(epoch, net_copy, debug)
-                    neff_min = SamplerReweight.get_effective_sample_size(temporary_samplers=samplers)
+                    neff_min = SamplerReweight.get_effective_sample_size(temporary_samplers=samplers, nprocs=nprocs,
+                                                                         neff_threshold=self.neff_threshold)
 
                     # If effective sample size is below threshold, update SamplerReweight.samplers and re-run simulaton
                     if neff_min < self.neff_threshold:
                         _logger.info(f'Minimum effective sample size ({neff_min:.3f}) below threshold ({self.neff_threshold})')
                         SamplerReweight.samplers = samplers
-                        SamplerReweight.run()
+                        SamplerReweight.run(max_workers=max_workers)
                     del samplers
 
                     # Compute sampler loss
-                    loss_list = SamplerReweight.compute_loss()   # list of torch.tensor
+                    loss_list = SamplerReweight.compute_loss(max_workers=max_workers)   # list of torch.tensor
                     for sampler_index, sampler_loss in enumerate(loss_list):
                         sampler = SamplerReweight.samplers[sampler_index]
                         loss += sampler_loss * sampler_weight
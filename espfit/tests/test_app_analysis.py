@@ -37,4 +37,18 @@ def test_compute_jcouplings_all(_get_input_directory_path):
     couplings = data.compute_jcouplings()
     
     assert couplings is not None
-    
\ No newline at end of file
+    
+
+def test_compute_jcouplings_uniform_weights(_get_input_directory_path):
+    import numpy as np
+
+    input_directory_path = _get_input_directory_path
+    data = RNASystem(input_directory_path=input_directory_path)
+    data.load_traj()
+    n_frames = data.traj.n_frames
+    couplings = data.compute_jcouplings(weights=np.ones(n_frames) / n_frames, couplings=['H1H2', 'H2H3', 'H3H4'])
+
+    # Uniform weights should reproduce the non-weighted average
+    for values_by_names in couplings.values():
+        for value in values_by_names.values():
+            assert value['avg'] == pytest.approx(value['avg_raw'], abs=1e-4)
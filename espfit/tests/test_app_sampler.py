@@ -202,3 +202,21 @@ def test_create_system_from_xml(test_create_test_espaloma_system):
     # If the same file exists, then suffix number will be added to the file name. 
     n_files = len(glob.glob(os.path.join(c.output_directory_path, 'state*.xml')))
     assert n_files == 2
+
+
+def test_force_groups(test_create_test_espaloma_system):
+    """Test that each force is assigned to its own force group.
+
+    Parameters
+    ----------
+    test_create_test_espaloma_system : espfit.app.sampler.SetupSampler
+        Test system instance.
+
+    Returns
+    -------
+    None
+    """
+    c = test_create_test_espaloma_system
+    groups = [ force.getForceGroup() for force in c.simulation.system.getForces() ]
+
+    assert groups == [ min(i, 31) for i in range(len(groups)) ]
@@ -0,0 +1,414 @@
+import os
+import pytest
+from collections import OrderedDict
+from importlib.resources import files
+from espfit.utils.sampler import reweight
+from espfit.utils.sampler.reweight import SetupSamplerReweight
+
+
+@pytest.fixture
+def count_yaml_load(monkeypatch):
+    """Fixture function to start from an empty yaml cache and count the number of parsed yaml files.
+
+    Returns
+    -------
+    counter : dict
+        Dictionary storing the number of `yaml.load` calls.
+    """
+    monkeypatch.setattr(reweight, '_YAML_CACHE', OrderedDict())
+    counter = {'n': 0}
+    yaml_load = reweight.yaml.load
+    def _load(*args, **kwargs):
+        counter['n'] += 1
+        return yaml_load(*args, **kwargs)
+    monkeypatch.setattr(reweight.yaml, 'load', _load)
+
+    return counter
+
+
+def test_get_experiment_data_cache(count_yaml_load):
+    """Test that experimental data is parsed once and returned as an independent copy.
+
+    Returns
+    -------
+    None
+    """
+    yaml_file = os.path.realpath(str(files('espfit').joinpath('data/target/nucleoside/adenosine/experiment.yml')))
+
+    c = SetupSamplerReweight()
+    exp = c._get_experiment_data('nucleoside', 'adenosine')
+    assert yaml_file in reweight._YAML_CACHE
+    assert count_yaml_load['n'] == 1
+
+    exp.clear()   # Modify returned data
+    exp2 = c._get_experiment_data('nucleoside', 'adenosine')
+    assert count_yaml_load['n'] == 1
+    assert exp2
+    assert exp is not exp2
+
+
+@pytest.mark.parametrize('index', [0, 1])
+def test_get_experiment_data_cache_invalidate(count_yaml_load, index):
+    """Test that a changed mtime or file size triggers a reload of the experimental data.
+
+    Parameters
+    ----------
+    index : int
+        Index of the cached file stat to change. 0: st_mtime, 1: st_size.
+
+    Returns
+    -------
+    None
+    """
+    yaml_file = os.path.realpath(str(files('espfit').joinpath('data/target/nucleoside/adenosine/experiment.yml')))
+
+    c = SetupSamplerReweight()
+    c._get_experiment_data('nucleoside', 'adenosine')
+    assert count_yaml_load['n'] == 1
+
+    # Pretend that the file was modified after it was cached
+    cached = list(reweight._YAML_CACHE[yaml_file])
+    cached[index] -= 1
+    reweight._YAML_CACHE[yaml_file] = tuple(cached)
+
+    c._get_experiment_data('nucleoside', 'adenosine')
+    assert count_yaml_load['n'] == 2
+
+
+def _create_system(k=1000.0, charge=0.5):
+    """Create a small periodic system with four charged particles and two harmonic bonds.
+
+    Parameters
+    ----------
+    k : float, default=1000.0
+        Harmonic bond force constant in kJ/mol/nm^2.
+
+    charge : float, default=0.5
+        Absolute charge of the particles.
+
+    Returns
+    -------
+    system : openmm.System
+    """
+    import openmm
+
+    system = openmm.System()
+    system.setDefaultPeriodicBoxVectors(openmm.Vec3(2, 0, 0), openmm.Vec3(0, 2, 0), openmm.Vec3(0, 0, 2))
+    nonbonded = openmm.NonbondedForce()
+    nonbonded.setNonbondedMethod(openmm.NonbondedForce.PME)
+    nonbonded.setCutoffDistance(0.9)
+    for sign in [1, -1, 1, -1]:
+        system.addParticle(39.9)
+        nonbonded.addParticle(sign * charge, 0.3, 0.5)
+    bond = openmm.HarmonicBondForce()
+    bond.addBond(0, 1, 0.15, k)
+    bond.addBond(2, 3, 0.15, k)
+    system.addForce(nonbonded)
+    system.addForce(bond)
+    for i, force in enumerate(system.getForces()):
+        force.setForceGroup(i)
+
+    return system
+
+
+def _create_sampler(system, output_directory_path, target_name):
+    """Create a minimal sampler with the attributes used by SetupSamplerReweight.
+
+    Returns
+    -------
+    sampler : types.SimpleNamespace
+    """
+    import types
+    import mdtraj
+    import openmm
+    from openmm import app, unit
+
+    topology = mdtraj.load(os.path.join(output_directory_path, 'solvated.pdb')).topology.to_openmm()
+    integrator = openmm.LangevinMiddleIntegrator(300 * unit.kelvin, 1 / unit.picosecond, 0.002 * unit.picoseconds)
+    platform = openmm.Platform.getPlatformByName('Reference')
+    simulation = app.Simulation(topology, system, integrator, platform)
+    sampler = types.SimpleNamespace(target_name=target_name, temperature=300 * unit.kelvin, 
+                                    output_directory_path=output_directory_path, simulation=simulation)
+
+    return sampler
+
+
+@pytest.fixture
+def test_create_trajectory(tmpdir):
+    """Fixture function to write a small trajectory with a fluctuating box (traj.nc and solvated.pdb).
+
+    Returns
+    -------
+    output_directory_path : str
+    """
+    import mdtraj
+    import numpy as np
+
+    top = mdtraj.Topology()
+    chain = top.add_chain()
+    for _ in range(2):
+        residue = top.add_residue('AR2', chain)
+        a1 = top.add_atom('AR1', mdtraj.element.argon, residue)
+        a2 = top.add_atom('AR2', mdtraj.element.argon, residue)
+        top.add_bond(a1, a2)
+
+    n_frames = 20
+    rng = np.random.default_rng(0)
+    lengths = np.linspace(2.0, 2.2, n_frames)[:, None].repeat(3, axis=1)
+    xyz = np.empty((n_frames, 4, 3))
+    xyz[:, 0] = rng.uniform(0.2, 0.8, (n_frames, 3))
+    xyz[:, 2] = rng.uniform(1.2, 1.8, (n_frames, 3))
+    xyz[:, 1] = xyz[:, 0] + rng.normal(0.15, 0.01, (n_frames, 3)) / np.sqrt(3)
+    xyz[:, 3] = xyz[:, 2] + rng.normal(0.15, 0.01, (n_frames, 3)) / np.sqrt(3)
+    traj = mdtraj.Trajectory(xyz, top, unitcell_lengths=lengths, unitcell_angles=np.full((n_frames, 3), 90.0))
+
+    output_directory_path = str(tmpdir)
+    traj[0].save_pdb(os.path.join(output_directory_path, 'solvated.pdb'))
+    traj.save_netcdf(os.path.join(output_directory_path, 'traj.nc'))
+
+    return output_directory_path
+
+
+def _compute_reference_log_weights(system0, system1, output_directory_path, beta):
+    """Compute log weights with fresh contexts evaluating all force groups.
+
+    Returns
+    -------
+    log_w : numpy.ndarray
+    """
+    import mdtraj
+    import numpy as np
+    import openmm
+    from openmm import unit
+
+    traj = mdtraj.load(os.path.join(output_directory_path, 'traj.nc'), top=os.path.join(output_directory_path, 'solvated.pdb'))
+    platform = openmm.Platform.getPlatformByName('Reference')
+    contexts = [ openmm.Context(system, openmm.VerletIntegrator(0.001), platform) for system in [system0, system1] ]
+    log_w = []
+    for i in range(traj.n_frames):
+        u = []
+        for context in contexts:
+            context.setPeriodicBoxVectors(*traj.openmm_boxes(i))
+            context.setPositions(traj.openmm_positions(i))
+            u.append(context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilocalories_per_mole))
+        log_w.append(-beta * (u[1] - u[0]))
+
+    return np.array(log_w)
+
+
+@pytest.mark.parametrize('nprocs', [1, 2])
+def test_get_effective_sample_size(test_create_trajectory, nprocs):
+    """Test effective sample size and weights with serial and parallel energy evaluation.
+
+    The box of the sampler context differs from the trajectory box to check that the box 
+    vectors of each frame are used.
+
+    Parameters
+    ----------
+    nprocs : int
+        Number of processes.
+
+    Returns
+    -------
+    None
+    """
+    import numpy as np
+    import openmm
+    from espfit.utils.units import KB_T_KCALPERMOL
+
+    output_directory_path = test_create_trajectory
+    system0, system1 = _create_system(k=1000.0, charge=0.5), _create_system(k=1200.0, charge=0.55)
+    sampler = _create_sampler(system0, output_directory_path, 'target')
+    temporary_sampler = _create_sampler(system1, output_directory_path, 'target')
+    sampler.simulation.context.setPeriodicBoxVectors(openmm.Vec3(2.5, 0, 0), openmm.Vec3(0, 2.5, 0), openmm.Vec3(0, 0, 2.5))
+
+    c = SetupSamplerReweight()
+    c.samplers = [sampler]
+    neff = c.get_effective_sample_size(temporary_samplers=[temporary_sampler], nprocs=nprocs)
+
+    log_w = _compute_reference_log_weights(system0, system1, output_directory_path, 1 / (KB_T_KCALPERMOL * 300))
+    w_i = np.exp(log_w - log_w.max())
+    w_i /= w_i.sum()
+    assert c.weights['target']['weights'] == pytest.approx(w_i, rel=1e-5)
+    assert neff == pytest.approx(1.0 / (w_i.size * np.dot(w_i, w_i)), rel=1e-5)
+
+
+@pytest.mark.parametrize('k, charge, expected', [(1000.0, 0.5, 0b00), (1200.0, 0.5, 0b10), (1000.0, 0.55, 0b01), (1200.0, 0.55, 0b11)])
+def test_get_changed_force_groups(k, charge, expected):
+    """Test the bitmask of force groups containing forces that differ between two systems.
+
+    Returns
+    -------
+    None
+    """
+    from espfit.utils.sampler.reweight import _get_changed_force_groups
+
+    assert _get_changed_force_groups(_create_system(), _create_system(k=k, charge=charge)) == expected
+
+
+def test_get_changed_force_groups_mismatch():
+    """Test that all force groups are used if the forces of the two systems cannot be matched.
+
+    Returns
+    -------
+    None
+    """
+    import openmm
+    from espfit.utils.sampler.reweight import _get_changed_force_groups
+
+    # Different number of forces
+    system = _create_system()
+    system.addForce(openmm.CMMotionRemover())
+    assert _get_changed_force_groups(_create_system(), system) == -1
+
+    # Different force groups
+    system = _create_system()
+    system.getForce(1).setForceGroup(5)
+    assert _get_changed_force_groups(_create_system(), system) == -1
+
+
+@pytest.mark.parametrize('k, charge', [(1200.0, 0.5), (1000.0, 0.55)])
+def test_compute_log_weights_force_groups(test_create_trajectory, k, charge):
+    """Test that evaluating only the changed force groups gives the same log weights as all force groups.
+
+    The boxes of the two contexts differ from each other and from the trajectory box.
+
+    Returns
+    -------
+    None
+    """
+    import openmm
+    from espfit.utils.sampler.reweight import _compute_log_weights, _get_changed_force_groups
+
+    output_directory_path = test_create_trajectory
+    traj_file = os.path.join(output_directory_path, 'traj.nc')
+    top_file = os.path.join(output_directory_path, 'solvated.pdb')
+    system0, system1 = _create_system(), _create_system(k=k, charge=charge)
+    platform = openmm.Platform.getPlatformByName('Reference')
+    ctx0 = openmm.Context(system0, openmm.VerletIntegrator(0.001), platform)
+    ctx1 = openmm.Context(system1, openmm.VerletIntegrator(0.001), platform)
+    ctx0.setPeriodicBoxVectors(openmm.Vec3(2.5, 0, 0), openmm.Vec3(0, 2.5, 0), openmm.Vec3(0, 0, 2.5))
+
+    groups = _get_changed_force_groups(system0, system1)
+    assert groups not in (0, -1)
+    log_w_masked = _compute_log_weights(ctx0, ctx1, traj_file, top_file, 1.0, 0, 20, groups=groups)
+    log_w_full = _compute_log_weights(ctx0, ctx1, traj_file, top_file, 1.0, 0, 20)
+
+    assert log_w_masked == pytest.approx(log_w_full, rel=1e-6, abs=1e-6)
+
+
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_run_samplers(max_workers):
+    """Test running samplers sequentially and concurrently, including an empty sampler list.
+
+    Returns
+    -------
+    None
+    """
+    import types
+
+    calls = []
+    samplers = [ types.SimpleNamespace(target_name=name, nsteps=0, minimize=lambda: None, run=lambda name=name: calls.append(name)) 
+                 for name in ['a', 'b', 'c'] ]
+
+    c = SetupSamplerReweight()
+    c.samplers = []
+    c.run(max_workers=max_workers)
+    assert c.compute_loss(max_workers=max_workers) == []
+
+    c.samplers = samplers
+    c.run(max_workers=max_workers)
+    assert sorted(calls) == ['a', 'b', 'c']
+
+
+def test_get_effective_sample_size_type(test_create_trajectory):
+    """Test that the effective sample size is returned as a python float and weights as float64.
+
+    Returns
+    -------
+    None
+    """
+    import numpy as np
+
+    output_directory_path = test_create_trajectory
+    c = SetupSamplerReweight()
+    c.samplers = [_create_sampler(_create_system(), output_directory_path, 'target')]
+    neff = c.get_effective_sample_size(temporary_samplers=[_create_sampler(_create_system(k=1200.0), output_directory_path, 'target')])
+
+    assert type(neff) is float
+    assert type(c.weights['target']['neff']) is float
+    assert c.weights['target']['weights'].dtype == np.float64
+
+
+def test_get_effective_sample_size_early_exit(test_create_trajectory, monkeypatch):
+    """Test that weights are not reused after an early exit and re-running the samplers.
+
+    The first sampler is below the effective sample size threshold, so the second sampler is skipped
+    and keeps the weights of the previous call until the samplers are re-run.
+
+    Returns
+    -------
+    None
+    """
+    import numpy as np
+
+    output_directory_path = test_create_trajectory
+    samplers = [ _create_sampler(_create_system(), output_directory_path, name) for name in ['a', 'b'] ]
+    temporary_samplers = [ _create_sampler(_create_system(k=2000.0, charge=0.6), output_directory_path, name) for name in ['a', 'b'] ]
+    for sampler in temporary_samplers:
+        sampler.nsteps = 0
+        sampler.minimize = lambda: None
+        sampler.run = lambda: None
+
+    c = SetupSamplerReweight()
+    c.samplers = samplers
+    c.weights['b'] = {'neff': 1.0, 'weights': np.ones(5) / 5}   # Weights from a previous call
+    neff = c.get_effective_sample_size(temporary_samplers=temporary_samplers, neff_threshold=1.0)
+
+    assert neff < 1.0
+    assert neff == c.weights['a']['neff']
+
+    # Replace and re-run samplers as done in EspalomaModel.train_sampler
+    c.samplers = temporary_samplers
+    c.run()
+    assert c.weights == dict()
+
+    # Record weights passed to compute the observable
+    class _RNASystem(object):
+        def __init__(self, **kwargs):
+            pass
+        def load_traj(self, input_directory_path=None):
+            pass
+        def compute_jcouplings(self, weights=None):
+            return {'weights': None if weights is None else len(weights)}
+    monkeypatch.setattr(reweight, 'RNASystem', _RNASystem)
+
+    passed_weights = dict()
+    for name in ['a', 'b']:
+        passed_weights[name] = c._compute_weighted_observable('solute', name, output_directory_path)['weights']
+    assert passed_weights == {'a': None, 'b': None}
+
+
+def test_compute_loss_per_system_undefined_prediction(monkeypatch):
+    """Test that observables without prediction are skipped and the loss stays float32.
+
+    Returns
+    -------
+    None
+    """
+    import types
+    import torch
+
+    exp = {'resi_1': {'H1H2': {'name': 'nu_1', 'value': 1.0, 'operator': None, 'error': 0.5}, 
+                      'H2H3': {'name': 'nu_2', 'value': 2.0, 'operator': None, 'error': None}}}
+    pred = {'A_1_0': {'H1H2': {'avg': 2.0, 'std': 0.5}, 'H2H3': {'avg': None, 'std': None}}}
+
+    c = SetupSamplerReweight()
+    monkeypatch.setattr(c, '_get_experiment_data', lambda *args: exp)
+    monkeypatch.setattr(c, '_compute_weighted_observable', lambda *args: pred)
+    sampler = types.SimpleNamespace(target_class='nucleoside', target_name='adenosine', atomSubset='solute', 
+                                    output_directory_path=None)
+    loss = c._compute_loss_per_system(sampler)
+
+    assert loss.dtype == torch.float32
+    assert loss.item() == pytest.approx(2.0)
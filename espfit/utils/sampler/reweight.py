@@ -6,10 +6,36 @@ TODO
 * Check J-coupling experimental error. Currently, fixed to 0.5 Hz.
 """
 import os
+import copy
+import hashlib
 import logging
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from importlib.resources import files
+import mdtraj
+import numpy as np
+import torch
+import yaml
+from openmm import Context, Platform, Vec3, XmlSerializer, unit
+from openmm.unit import kilocalories_per_mole as kcalpermol
+from espfit.app.analysis import RNASystem
+from espfit.utils.units import KB_T_KCALPERMOL
+
+# Use LibYAML C bindings if available
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
 
 _logger = logging.getLogger(__name__)
 
+# Cache of parsed experiment yaml files {path: (st_mtime, st_size, content)}
+_YAML_CACHE = OrderedDict()
+_YAML_CACHE_MAX = 100
+_YAML_CACHE_LOCK = threading.Lock()
+
 
 class SetupSamplerReweight(object):
     """Setup sampler for reweighting simulation.
@@ -20,34 +46,54 @@ class SetupSamplerReweight(object):
 
     Methods
     -------
-    run():
+    run(max_workers=1):
         Runs the simulation for each sampler.
 
-    get_effective_sample_size(temporary_samplers):
+    get_effective_sample_size(temporary_samplers, nprocs=1, neff_threshold=0.0):
         Computes the effective sample size and sampling weights for each sampler.
 
-    compute_loss():
+    compute_loss(max_workers=1):
         Computes the loss for each sampler.    
     """
     def __init__(self):
         self.samplers = None
         self.weights = dict()   # {'target_name': {'weights': w_i}, {'neff': neff}}
+        self._last_pred_hash = dict()   # {'path/to/pred.yaml': hash}
 
 
-    def run(self):
+    def run(self, max_workers=1):
         """Runs the simulation for each sampler.
+
+        Weights computed from the previous trajectories are discarded.
+
+        Parameters
+        ----------
+        max_workers : int, default=1
+            Maximum number of threads used to run the samplers concurrently. Default is 1 (sequential).
+            Only useful if the samplers run on different devices or CPU cores are available.
         
         Returns
         -------
         None
         """
-        for sampler in self.samplers:
+        def _run(sampler):
             _logger.info(f'Running simulation for {sampler.target_name} for {sampler.nsteps} steps...')
             sampler.minimize()
             sampler.run()
 
+        # Weights of the previous trajectories do not apply to the new trajectories
+        self.weights.clear()
 
-    def get_effective_sample_size(self, temporary_samplers):
+        if max_workers > 1 and len(self.samplers) > 1:
+            # Samplers do not share any state. OpenMM releases the GIL while running the simulation.
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(self.samplers))) as executor:
+                list(executor.map(_run, self.samplers))
+        else:
+            for sampler in self.samplers:
+                _run(sampler)
+
+
+    def get_effective_sample_size(self, temporary_samplers, nprocs=1, neff_threshold=0.0):
         """Computes the effective sample size and sampling weights for each sampler.
 
         Parameters
@@ -55,79 +101,154 @@ class SetupSamplerReweight(object):
         temporary_samplers : list
             List of temporary samplers.
 
+        nprocs : int, default=1
+            Number of processes used to compute the potential energies of the trajectory frames.
+            If larger than 1, a pool of spawned worker processes is created for each call and shared by
+            all samplers. Each worker imports this module (including torch, mdtraj and openmm) and builds
+            its own pair of contexts for each sampler, so this only pays off for long trajectories.
+            Spawned workers re-import the `__main__` module of the calling script, which must therefore
+            guard its entry point with `if __name__ == '__main__':`.
+
+        neff_threshold : float, default=0.0
+            Minimum effective sample size threshold. If the effective sample size of a sampler falls 
+            below the threshold, the remaining samplers are skipped and the effective sample size is returned.
+
         Returns
         -------
         float
             The minimum effective sample size among all samplers.
         """
-        import mdtraj
-        import numpy as np
-        from openmm.unit import kilocalories_per_mole as kcalpermol
-        from espfit.utils.units import KB_T_KCALPERMOL
-        
         if self.samplers is None:
             return -1
 
-        for sampler, temporary_sampler in zip(self.samplers, temporary_samplers):
-            _logger.info(f'Compute effective sample size and sampling weights for {sampler.target_name}')
-
-            # Get temperature
-            temp0 = sampler.temperature._value
-            temp1 = temporary_sampler.temperature._value
-            assert temp0 == temp1, f'Temperature should be equivalent but got sampler {temp0} K and temporary sampler {temp1} K'
-            beta = 1 / (KB_T_KCALPERMOL * temp0)
-            _logger.debug(f'beta temperature in kcal/mol: {beta}')
-
-            # Get position from trajectory
-            traj = mdtraj.load(sampler.output_directory_path + '/traj.nc', top=sampler.output_directory_path + '/solvated.pdb')
-            _logger.info(f'Found {traj.n_frames} frames in trajectory')
-            
-            # Compute weights and effective sample size
-            log_w = []
-            for i in range(traj.n_frames):
-                # U(x0, theta0)
-                sampler.simulation.context.setPositions(traj.openmm_positions(i))
-                potential_energy = sampler.simulation.context.getState(getEnergy=True).getPotentialEnergy()
-                # U(x0, theta1)
-                temporary_sampler.simulation.context.setPositions(traj.openmm_positions(i))
-                reduced_potential_energy = temporary_sampler.simulation.context.getState(getEnergy=True).getPotentialEnergy()
-                # deltaU = U(x0, theta1) - U(x0, theta0)
-                delta = (reduced_potential_energy - potential_energy).value_in_unit(kcalpermol)
-                # log_w = ln(exp(-beta * delta))
-                w = -1 * beta * delta
-                log_w.append(w)
-
-                #_logger.debug(f'U(x0, theta0): {potential_energy.value_in_unit(kcalpermol):10.3f} kcal/mol')
-                #_logger.debug(f'U(x0, theta1): {reduced_potential_energy.value_in_unit(kcalpermol):10.3f} kcal/mol')
-                #_logger.debug(f'deltaU:        {delta:10.3f} kcal/mol')
-                #_logger.debug(f'log_w:         {w:10.3f}')
-
-            # Compute weights and effective sample size (ratio: 0 to 1)
-            w_i = np.exp(log_w) / np.sum(np.exp(log_w))
-            neff = np.sum(w_i) ** 2 / np.sum(w_i ** 2) / len(w_i)
-            #_logger.debug(f'w_i_sum:       {np.sum(w_i):10.3f}')
-            #_logger.debug(f'neff:          {neff:10.3f}')
-
-            self.weights[f'{sampler.target_name}'] = {'neff': neff, 'weights': w_i}
-            #_logger.info(f'{self.weights}')
-            neffs = [self.weights[key]['neff'] for key in self.weights.keys()]
-
-        return min(neffs)
+        # The worker pool is shared by all samplers. Worker processes are spawned (not forked) to avoid
+        # inheriting the OpenMM (e.g. CUDA) state of this process.
+        pool = multiprocessing.get_context('spawn').Pool(nprocs) if nprocs > 1 else None
+        try:
+            min_neff = float('inf')
+            for sampler, temporary_sampler in zip(self.samplers, temporary_samplers):
+                neff = self._compute_weights(sampler, temporary_sampler, pool, nprocs)
+                min_neff = min(min_neff, neff)
+                if neff < neff_threshold:
+                    _logger.warning(f'Effective sample size ({neff:.3f}) for {sampler.target_name} '
+                                    f'below threshold ({neff_threshold}). Skip remaining samplers.')
+                    return neff
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        return min_neff
+
+
+    def _compute_weights(self, sampler, temporary_sampler, pool=None, nprocs=1):
+        """Computes the sampling weights and effective sample size for a given sampler.
+
+        Parameters
+        ----------
+        sampler : object
+            The sampler object.
+
+        temporary_sampler : object
+            The temporary sampler object with the updated parameters.
+
+        pool : multiprocessing.pool.Pool, optional
+            Worker pool used to compute the potential energies. Default is None (no worker pool).
+
+        nprocs : int, default=1
+            Number of processes of the worker pool.
+
+        Returns
+        -------
+        float
+            The effective sample size.
+        """
+        _logger.info(f'Compute effective sample size and sampling weights for {sampler.target_name}')
+
+        # Get temperature
+        temp0 = sampler.temperature._value
+        temp1 = temporary_sampler.temperature._value
+        assert temp0 == temp1, f'Temperature should be equivalent but got sampler {temp0} K and temporary sampler {temp1} K'
+        beta = 1 / (KB_T_KCALPERMOL * temp0)
+        _logger.debug(f'beta temperature in kcal/mol: {beta}')
+
+        # Get number of frames without loading the trajectory into memory
+        traj_file = os.path.join(sampler.output_directory_path, 'traj.nc')
+        top_file = os.path.join(sampler.output_directory_path, 'solvated.pdb')
+        with mdtraj.open(traj_file) as f:
+            n_frames = len(f)
+        _logger.info(f'Found {n_frames} frames in trajectory')
+        
+        # Only force groups that differ between the two systems contribute to deltaU
+        groups = _get_changed_force_groups(sampler.simulation.system, temporary_sampler.simulation.system)
+        _logger.debug(f'Force groups used to compute deltaU: {groups:#x}')
+
+        # Compute log weights
+        if pool is not None and n_frames > 0:
+            # Split frames across worker processes. Each worker builds and caches its own pair of contexts
+            # from the serialized systems and integrators passed with the tasks.
+            # Platform property defaults (e.g. Precision) set in this process are not inherited by spawned workers.
+            platform = sampler.simulation.context.getPlatform()
+            properties = { name: platform.getPropertyDefaultValue(name) for name in platform.getPropertyNames() }
+            properties = { name: value for name, value in properties.items() if value }
+            xmls = (
+                XmlSerializer.serialize(sampler.simulation.system),
+                XmlSerializer.serialize(sampler.simulation.integrator),
+                XmlSerializer.serialize(temporary_sampler.simulation.system),
+                XmlSerializer.serialize(temporary_sampler.simulation.integrator),
+            )
+            key = hashlib.blake2b(''.join(xmls).encode('utf8'), digest_size=16).hexdigest()
+            contexts_args = (key, xmls, platform.getName(), properties)
+            chunk = max(1, n_frames // (4 * nprocs))
+            tasks = [ (contexts_args, (traj_file, top_file, beta, start, min(start + chunk, n_frames), groups))
+                      for start in range(0, n_frames, chunk) ]
+            log_w = np.concatenate(pool.map(_compute_log_weights_worker, tasks))
+        else:
+            log_w = _compute_log_weights(sampler.simulation.context, temporary_sampler.simulation.context, 
+                                         traj_file, top_file, beta, 0, n_frames, groups)
+
+        # Compute weights and effective sample size (ratio: 0 to 1)
+        if log_w.size == 0:
+            _logger.warning(f'No frames found in {traj_file}. Set effective sample size to 0.')
+            w_i, neff = log_w, 0.0
+        else:
+            # Subtract max(log_w) before exponentiating to avoid overflow (log-sum-exp trick).
+            # The shift cancels out in the normalized weights.
+            e = np.exp(log_w - log_w.max())
+            w_i = e / e.sum()
+            # sum(w_i) is 1 since w_i is normalized
+            neff = float(1.0 / (w_i.size * np.dot(w_i, w_i)))
+        #_logger.debug(f'w_i_sum:       {np.sum(w_i):10.3f}')
+        #_logger.debug(f'neff:          {neff:10.3f}')
+
+        self.weights[f'{sampler.target_name}'] = {'neff': neff, 'weights': w_i}
+        #_logger.info(f'{self.weights}')
+
+        return neff
     
         
-    def compute_loss(self):
+    def compute_loss(self, max_workers=1):
         """Computes the loss for each sampler.
 
+        Parameters
+        ----------
+        max_workers : int, default=1
+            Maximum number of threads used to compute the loss of the samplers concurrently. Default is 1 (sequential).
+
         Returns
         -------
         list
             List of torch tensors representing the loss for each sampler.
         """
-        loss_list = []
-        for sampler in self.samplers:
+        def _compute_loss(sampler):
             _logger.info(f'Compute loss for {sampler.target_name}')
-            loss = self._compute_loss_per_system(sampler)  # torch.tensor
-            loss_list.append(loss)
+            return self._compute_loss_per_system(sampler)  # torch.tensor
+
+        if max_workers > 1 and len(self.samplers) > 1:
+            # The order of the samplers is preserved
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(self.samplers))) as executor:
+                loss_list = list(executor.map(_compute_loss, self.samplers))
+        else:
+            loss_list = [ _compute_loss(sampler) for sampler in self.samplers ]
 
         return loss_list
     
@@ -145,13 +266,12 @@ class SetupSamplerReweight(object):
         torch.Tensor
             The loss per system as a torch tensor.
         """
-        import torch
-
         # Compute experimental observable
         exp = self._get_experiment_data(sampler.target_class, sampler.target_name)
         pred = self._compute_weighted_observable(sampler.atomSubset, sampler.target_name, sampler.output_directory_path)
 
-        loss = []
+        exp_values, exp_errors, pred_values, pred_errors = [], [], [], []
+        pred_list = list(pred.values())
         for resi_index, exp_dict in enumerate(exp.values()):
             for key, value in exp_dict.items():
                 # {'1H5P': {'name': 'beta_1', 'value': None, 'operator': None, 'error': None}}
@@ -163,17 +283,30 @@ class SetupSamplerReweight(object):
                     exp_error = value['error']
                     if exp_error == None:
                         exp_error = 0.5  # TODO: Check experimental error
-                    resi_index = int(resi_index)
-                    pred_value = list(pred.values())[resi_index][key]['avg']
-                    pred_error = list(pred.values())[resi_index][key]['std']
+                    pred_value = pred_list[resi_index][key]['avg']
+                    pred_error = pred_list[resi_index][key]['std']
+                    if pred_value is None or pred_error is None:
+                        # Coupling could not be computed (NaN) from the trajectory
+                        _logger.warning(f'Skip undefined prediction ({resi_index}-{key}): '
+                                        f'avg={pred_value}, std={pred_error}')
+                        continue
                     _logger.debug(f'Exp ({resi_index}-{key}): {exp}')
                     _logger.debug(f'Pred ({resi_index}-{key}): {pred}')
 
-                    numerator = (pred_value - exp_value) ** 2
-                    dominator = (exp_error ** 2 + pred_error ** 2)
-                    loss.append(numerator / dominator)
+                    exp_values.append(exp_value)
+                    exp_errors.append(exp_error)
+                    pred_values.append(pred_value)
+                    pred_errors.append(pred_error)
+
         # Compute loss
-        loss_avg = torch.mean(torch.tensor(loss))
+        exp_values = np.asarray(exp_values, dtype=np.float64)
+        exp_errors = np.asarray(exp_errors, dtype=np.float64)
+        pred_values = np.asarray(pred_values, dtype=np.float64)
+        pred_errors = np.asarray(pred_errors, dtype=np.float64)
+        numerator = pred_values - exp_values
+        numerator *= numerator
+        dominator = exp_errors * exp_errors + pred_errors * pred_errors
+        loss_avg = torch.from_numpy(numerator / dominator).mean().float()
         _logger.info(f'Sampler loss: {loss_avg.item():.3f}')
 
         return loss_avg
@@ -194,15 +327,26 @@ class SetupSamplerReweight(object):
         -------
         dict : The experimental data for the target.
         """
-        import yaml
-        from importlib.resources import files
-
         yaml_file = str(files('espfit').joinpath(f'data/target/{target_class}/{target_name}/experiment.yml'))
-        with open(yaml_file, 'r', encoding='utf8') as f:
-            d = yaml.safe_load(f)
+        yaml_file = os.path.realpath(yaml_file)
+
+        # Reuse parsed content if the file has not been modified since it was last loaded
+        stat = os.stat(yaml_file)
+        with _YAML_CACHE_LOCK:
+            cached = _YAML_CACHE.get(yaml_file)
+            if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+                _YAML_CACHE.move_to_end(yaml_file)
+                d = cached[2]
+            else:
+                with open(yaml_file, 'r', encoding='utf8') as f:
+                    d = yaml.load(f, Loader=_Loader)
+                _YAML_CACHE[yaml_file] = (stat.st_mtime, stat.st_size, d)
+                if len(_YAML_CACHE) > _YAML_CACHE_MAX:
+                    _YAML_CACHE.popitem(last=False)
 
         # {'resi_1': {'1H5P': {'name': 'beta_1', 'value': None, 'operator': None, 'error': None}}}
-        return d['experiment_1']['measurement']
+        # Return a copy so that downstream modification does not affect the cache
+        return copy.deepcopy(d['experiment_1']['measurement'])
 
 
     def _compute_weighted_observable(self, atomSubset, target_name, output_directory_path):
@@ -223,22 +367,184 @@ class SetupSamplerReweight(object):
         -------
         dict : The computed weighted observable.
         """
-        import yaml
-        from espfit.app.analysis import RNASystem
-
         # Load trajectory
         target = RNASystem(atomSubset=atomSubset)
         target.load_traj(input_directory_path=output_directory_path)
         
         # Compute observable
-        if self.weights.keys():
+        if target_name in self.weights:
             pred = target.compute_jcouplings(weights=self.weights[target_name]['weights'])
         else:
             pred = target.compute_jcouplings(weights=None)
         _logger.debug(f'Computed observable: {pred}')
 
-        # Export observable
-        with open(os.path.join(output_directory_path, 'pred.yaml'), 'w') as f:
-            yaml.dump(pred, f, allow_unicode=True)
+        # Export observable only if it has changed since the last export.
+        # Write to a temporary file first and rename it to avoid partially written files.
+        path = os.path.join(output_directory_path, 'pred.yaml')
+        buf = yaml.dump(pred, Dumper=_Dumper, allow_unicode=True).encode('utf8')
+        digest = hashlib.blake2b(buf, digest_size=16).digest()
+        if self._last_pred_hash.get(path) != digest or not os.path.exists(path):
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(buf)
+            os.replace(tmp, path)
+            self._last_pred_hash[path] = digest
 
         return pred
+
+
+def _get_changed_force_groups(system0, system1):
+    """Gets the bitmask of force groups that contain forces differing between two systems.
+
+    Forces that are identical in both systems contribute equally to U(x, theta0) and U(x, theta1)
+    and cancel out in deltaU. Their force groups can be skipped if they do not share a force group
+    with any differing force.
+
+    Parameters
+    ----------
+    system0 : openmm.System
+        System with the original parameters (theta0).
+
+    system1 : openmm.System
+        System with the updated parameters (theta1).
+
+    Returns
+    -------
+    int : Bitmask of force groups. -1 (all force groups) if the forces of the two systems cannot be matched.
+    """
+    if system0.getNumForces() != system1.getNumForces():
+        return -1
+
+    groups = 0
+    for force0, force1 in zip(system0.getForces(), system1.getForces()):
+        if force0.getForceGroup() != force1.getForceGroup():
+            return -1
+        if XmlSerializer.serialize(force0) != XmlSerializer.serialize(force1):
+            groups |= 1 << force0.getForceGroup()
+
+    return groups
+
+
+# Pairs of contexts (theta0, theta1) held by each worker process {key: (ctx0, ctx1)}
+_worker_contexts = dict()
+
+
+def _get_worker_contexts(key, xmls, platform_name, properties):
+    """Gets the OpenMM contexts of a worker process, creating them from serialized xml strings if needed.
+
+    Parameters
+    ----------
+    key : str
+        Key identifying the serialized systems and integrators.
+
+    xmls : tuple of str
+        Serialized system and integrator of the sampler, followed by those of the temporary sampler.
+
+    platform_name : str
+        Name of the OpenMM platform.
+
+    properties : dict
+        Platform properties used to create the contexts.
+
+    Returns
+    -------
+    tuple : The contexts with the original (theta0) and updated (theta1) parameters.
+    """
+    if key not in _worker_contexts:
+        platform = Platform.getPlatformByName(platform_name)
+        system_xml0, integrator_xml0, system_xml1, integrator_xml1 = xmls
+        contexts = []
+        for system_xml, integrator_xml in [(system_xml0, integrator_xml0), (system_xml1, integrator_xml1)]:
+            system = XmlSerializer.deserialize(system_xml)
+            integrator = XmlSerializer.deserialize(integrator_xml)
+            contexts.append(Context(system, integrator, platform, properties))
+        _worker_contexts[key] = tuple(contexts)
+
+    return _worker_contexts[key]
+
+
+def _compute_log_weights_worker(task):
+    """Computes the log weights of a frame range in a worker process.
+
+    Parameters
+    ----------
+    task : tuple
+        Arguments passed to `_get_worker_contexts` and arguments passed to `_compute_log_weights`
+        except for the contexts.
+
+    Returns
+    -------
+    numpy.ndarray : The log weights of the frame range.
+    """
+    contexts_args, args = task
+    return _compute_log_weights(*_get_worker_contexts(*contexts_args), *args)
+
+
+def _compute_log_weights(ctx0, ctx1, traj_file, top_file, beta, start, stop, groups=-1, chunk=1000):
+    """Computes the log weights, -beta * (U(x, theta1) - U(x, theta0)), for a range of trajectory frames.
+
+    Parameters
+    ----------
+    ctx0 : openmm.Context
+        Context with the original parameters (theta0).
+
+    ctx1 : openmm.Context
+        Context with the updated parameters (theta1).
+
+    traj_file : str
+        Trajectory file path.
+
+    top_file : str
+        Topology file path.
+
+    beta : float
+        Inverse temperature in mol/kcal.
+
+    start, stop : int
+        Range of frames to compute.
+
+    groups : int, default=-1
+        Bitmask of force groups used to compute the potential energies. Default is -1 (all force groups).
+
+    chunk : int, default=1000
+        Number of frames loaded into memory at once.
+
+    Returns
+    -------
+    numpy.ndarray : The log weights of the frame range.
+    """
+    n_frames = stop - start
+    if n_frames == 0:
+        return np.empty(0, dtype=np.float64)
+
+    u0 = np.empty(n_frames, dtype=np.float64)   # U(x0, theta0) in kcal/mol
+    u1 = np.empty(n_frames, dtype=np.float64)   # U(x0, theta1) in kcal/mol
+    i = 0
+    # Stream trajectory in chunks to bound memory usage for long simulations
+    for traj in mdtraj.iterload(traj_file, top=top_file, chunk=min(chunk, n_frames), skip=start):
+        # Contiguous float64 coordinates (nm) are passed to OpenMM as an array without building Vec3 objects per atom
+        xyz = np.ascontiguousarray(traj.xyz, dtype=np.float64)
+        box = traj.unitcell_vectors   # nm
+        for j in range(min(traj.n_frames, n_frames - i)):
+            # Both contexts share the same box vectors and positions of the frame
+            if box is not None:
+                box_vectors = [ Vec3(*v) for v in box[j].tolist() ]
+                ctx0.setPeriodicBoxVectors(*box_vectors)
+                ctx1.setPeriodicBoxVectors(*box_vectors)
+            positions = unit.Quantity(xyz[j], unit.nanometer)
+            # U(x0, theta0)
+            ctx0.setPositions(positions)
+            u0[i] = ctx0.getState(getEnergy=True, groups=groups).getPotentialEnergy().value_in_unit(kcalpermol)
+            # U(x0, theta1)
+            ctx1.setPositions(positions)
+            u1[i] = ctx1.getState(getEnergy=True, groups=groups).getPotentialEnergy().value_in_unit(kcalpermol)
+            i += 1
+        if i == n_frames:
+            break
+    if i != n_frames:
+        raise RuntimeError(f'Expected {n_frames} frames but read {i} frames from {traj_file}')
+
+    # log_w = ln(exp(-beta * deltaU)), where deltaU = U(x0, theta1) - U(x0, theta0)
+    log_w = -beta * (u1 - u0)
+
+    return log_w